@@ -0,0 +1,353 @@
+"""Shared VOICEVOX engine client for the voice generation scripts."""
+from __future__ import annotations
+
+import asyncio
+import atexit
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import sys
+import zipfile
+from collections.abc import Awaitable, Callable, Iterable
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from typing import TypeVar
+
+import aiohttp
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SPEAKER = 3  # ずんだもん（ノーマル）
+WARM_UP_TEXT = "あ"
+# Pin the engine output to 24kHz mono so we never pull more bytes than needed
+OUTPUT_FORMAT = {"outputSamplingRate": 24000, "outputStereo": False}
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Retry policy shared by the sync and async clients
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = (502, 503, 504)
+# audio_query for line N+1 overlaps synthesis of line N; keep both stages small
+# since a single VOICEVOX engine gains little from parallel requests.
+# Worker counts and request slots are per engine.
+QUERY_WORKERS = 2
+SYNTHESIS_WORKERS = 2
+ENGINE_SLOTS = 2
+_DONE = object()  # queue sentinel
+
+T = TypeVar("T")
+
+log = logging.getLogger(__name__)
+
+
+def setup_logging() -> None:
+    """Log to stdout from a background thread so workers never block on terminal writes."""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    # QueueHandler formats before enqueueing, so it needs the same bare format
+    queue_handler = QueueHandler(records)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+    listener = QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)  # drains pending records, also on sys.exit
+
+
+def cache_key(speaker: int, text: str, tuning: dict | None) -> str:
+    # OUTPUT_FORMAT is part of every request, so changing it must invalidate the cache too
+    payload = json.dumps([speaker, text, tuning or {}, OUTPUT_FORMAT], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_cached(out_path: Path, key: str) -> bool:
+    """True if out_path was generated from the inputs hashed into key."""
+    sidecar = out_path.with_suffix(".sha256")
+    return out_path.exists() and sidecar.exists() and sidecar.read_text(encoding="utf-8") == key
+
+
+def mark_cached(out_path: Path, key: str) -> None:
+    out_path.with_suffix(".sha256").write_text(key, encoding="utf-8")
+
+
+def plan_jobs(
+    jobs: Iterable[tuple[Path, str, T]], force: bool = False
+) -> tuple[list[tuple[Path, str, T]], list[tuple[Path, str, Path]]]:
+    """Split (out_path, key, data) jobs into those to synthesize and duplicates of them.
+
+    Cached jobs are dropped unless force is set. Identical text+tuning is synthesized
+    once per run: a later job with the same key comes back in dupes as
+    (out_path, key, source_path), to be copied once source_path is written.
+    """
+    pending: list[tuple[Path, str, T]] = []
+    dupes: list[tuple[Path, str, Path]] = []
+    first: dict[str, Path] = {}
+    for out_path, key, data in jobs:
+        if not force and is_cached(out_path, key):
+            log.info("Cached %s", out_path.name)
+        elif key in first:
+            dupes.append((out_path, key, first[key]))
+        else:
+            first[key] = out_path
+            pending.append((out_path, key, data))
+    if not pending:
+        # Nothing to synthesize: callers skip opening a connection to the engine
+        log.info("All lines up to date; skipping synthesis.")
+    return pending, dupes
+
+
+def unpack_multi_synthesis(archive: bytes, expected: int) -> list[bytes]:
+    # Entries are named 001.wav, 002.wav, ... in request order
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        wavs = [zf.read(name) for name in sorted(zf.namelist())]
+    if len(wavs) != expected:
+        raise ValueError(f"/multi_synthesis returned {len(wavs)} files for {expected} queries")
+    return wavs
+
+
+def make_session(pool_size: int = 8) -> requests.Session:
+    """Keep-alive session that retries transient 502/503/504s with backoff."""
+    session = requests.Session()
+    retry = Retry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,  # audio_query/synthesis are POST but idempotent
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class VoicevoxClient:
+    """Blocking client for one engine. Sessions may be shared between clients."""
+
+    def __init__(self, url: str, speaker: int = SPEAKER, session: requests.Session | None = None) -> None:
+        self.url = url.rstrip("/")
+        self.speaker = speaker
+        self.session = session or make_session()
+
+    def check(self) -> None:
+        r = self.session.get(f"{self.url}/speakers", timeout=10)
+        r.raise_for_status()
+
+    def audio_query(self, text: str, tuning: dict | None = None) -> dict:
+        r = self.session.post(
+            f"{self.url}/audio_query",
+            params={"text": text, "speaker": self.speaker},
+            timeout=30,
+        )
+        r.raise_for_status()
+        query = orjson.loads(r.content)
+        if tuning:
+            query.update(tuning)
+        return query
+
+    def synthesis(self, query: dict) -> bytes:
+        r = self.session.post(
+            f"{self.url}/synthesis",
+            params={"speaker": self.speaker},
+            data=orjson.dumps({**query, **OUTPUT_FORMAT}),
+            headers=JSON_HEADERS,
+            timeout=60,
+        )
+        r.raise_for_status()
+        return r.content
+
+    def synthesis_to(self, query: dict, out_path: Path) -> int:
+        """Stream the WAV to out_path in 64KiB chunks; returns the byte count.
+
+        The body goes to a temp file that only replaces out_path once complete,
+        so a broken response never clobbers an existing good file.
+        """
+        tmp_path = out_path.with_name(out_path.name + ".part")
+        try:
+            with self.session.post(
+                f"{self.url}/synthesis",
+                params={"speaker": self.speaker},
+                data=orjson.dumps({**query, **OUTPUT_FORMAT}),
+                headers=JSON_HEADERS,
+                stream=True,
+                timeout=60,
+            ) as r:
+                r.raise_for_status()
+                with open(tmp_path, "wb") as f:
+                    # iter_content re-raises urllib3 read errors as requests exceptions
+                    for chunk in r.iter_content(65536):
+                        f.write(chunk)
+                    size = f.tell()
+            os.replace(tmp_path, out_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return size
+
+    def synth(self, text: str, tuning: dict | None = None) -> bytes:
+        return self.synthesis(self.audio_query(text, tuning))
+
+    def warm_up(self) -> None:
+        """Throwaway synthesis so model load and connection setup don't land on the first real line."""
+        self.synth(WARM_UP_TEXT)
+
+
+class AsyncVoicevoxClient:
+    """aiohttp counterpart of VoicevoxClient; the caller owns the ClientSession."""
+
+    def __init__(self, session: aiohttp.ClientSession, url: str, speaker: int = SPEAKER) -> None:
+        self.session = session
+        self.url = url.rstrip("/")
+        self.speaker = speaker
+        self.has_multi_synthesis = True  # cleared on the first 404
+
+    async def version(self) -> str:
+        async with self.session.get(f"{self.url}/version", timeout=aiohttp.ClientTimeout(total=10)) as r:
+            r.raise_for_status()
+            return await r.text()
+
+    async def _post(self, path: str, timeout: float, **kwargs) -> bytes:
+        """POST and return the body, retrying connection errors and 502/503/504 like make_session()."""
+        for attempt in range(RETRY_TOTAL + 1):
+            try:
+                async with self.session.post(
+                    f"{self.url}{path}",
+                    timeout=aiohttp.ClientTimeout(total=timeout),
+                    **kwargs,
+                ) as r:
+                    if r.status not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+                        r.raise_for_status()
+                        return await r.read()
+            except aiohttp.ClientConnectionError:
+                if attempt == RETRY_TOTAL:
+                    raise
+            await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+        raise AssertionError("unreachable")
+
+    async def audio_query(self, text: str, tuning: dict | None = None) -> dict:
+        body = await self._post("/audio_query", 30, params={"text": text, "speaker": self.speaker})
+        query = orjson.loads(body)
+        if tuning:
+            query.update(tuning)
+        return query
+
+    async def synthesis(self, query: dict) -> bytes:
+        return await self._post(
+            "/synthesis",
+            60,
+            params={"speaker": self.speaker},
+            data=orjson.dumps({**query, **OUTPUT_FORMAT}),
+            headers=JSON_HEADERS,
+        )
+
+    async def multi_synthesis(self, queries: list[dict]) -> list[bytes] | None:
+        """Synthesize several queries in one request; None if the engine lacks /multi_synthesis."""
+        try:
+            archive = await self._post(
+                "/multi_synthesis",
+                60 * len(queries),
+                params={"speaker": self.speaker},
+                data=orjson.dumps([{**query, **OUTPUT_FORMAT} for query in queries]),
+                headers=JSON_HEADERS,
+            )
+        except aiohttp.ClientResponseError as e:
+            if e.status == 404:
+                return None
+            raise
+        return unpack_multi_synthesis(archive, len(queries))
+
+    async def synthesis_batch(self, queries: list[dict]) -> list[bytes]:
+        """One /multi_synthesis call when the engine has it, else one /synthesis per query."""
+        if len(queries) > 1 and self.has_multi_synthesis:
+            wavs = await self.multi_synthesis(queries)
+            if wavs is not None:
+                return wavs
+            log.warning("WARN: %s has no /multi_synthesis; falling back to /synthesis", self.url)
+            self.has_multi_synthesis = False
+        return [await self.synthesis(query) for query in queries]
+
+    async def synth(self, text: str, tuning: dict | None = None) -> bytes:
+        return await self.synthesis(await self.audio_query(text, tuning))
+
+    async def warm_up(self) -> None:
+        """Throwaway synthesis so model load and connection setup don't land on the first real line."""
+        await self.synth(WARM_UP_TEXT)
+
+
+async def _on_engine(pool: asyncio.Queue, call: Callable[..., Awaitable[T]], *args) -> T:
+    """Borrow an engine client for one call and hand it back, so work spreads across engines as they free up."""
+    client: AsyncVoicevoxClient = await pool.get()
+    try:
+        return await call(client, *args)
+    except (aiohttp.ClientError, asyncio.TimeoutError, zipfile.BadZipFile) as e:
+        log.error("ERROR: %s failed on %s: %s", call.__name__, client.url, e)
+        raise
+    finally:
+        pool.put_nowait(client)
+
+
+async def _query_worker(pool: asyncio.Queue, query: Callable, q_queue: asyncio.Queue, s_queue: asyncio.Queue) -> None:
+    while (batch := await q_queue.get()) is not _DONE:
+        queries = await asyncio.gather(*(_on_engine(pool, query, job) for job in batch))
+        await s_queue.put((batch, queries))
+
+
+async def _synthesis_worker(pool: asyncio.Queue, write: Callable, s_queue: asyncio.Queue) -> None:
+    while (item := await s_queue.get()) is not _DONE:
+        batch, queries = item
+        wavs = await _on_engine(pool, AsyncVoicevoxClient.synthesis_batch, queries)
+        for job, wav in zip(batch, wavs):
+            await write(job, wav)
+
+
+async def run_pipeline(
+    urls: list[str],
+    batches: Iterable[list[T]],
+    query: Callable[[AsyncVoicevoxClient, T], Awaitable[dict]],
+    write: Callable[[T, bytes], Awaitable[None]],
+    speaker: int = SPEAKER,
+) -> None:
+    """Synthesize every job across the engines at urls.
+
+    query(client, job) returns the AudioQuery for one job. Each batch goes to the
+    engine as one /multi_synthesis request where supported, and write(job, wav)
+    is awaited for every result.
+    """
+    n_query = QUERY_WORKERS * len(urls)
+    n_synthesis = SYNTHESIS_WORKERS * len(urls)
+    q_queue: asyncio.Queue = asyncio.Queue()
+    for batch in batches:
+        q_queue.put_nowait(batch)
+    for _ in range(n_query):
+        q_queue.put_nowait(_DONE)
+    s_queue: asyncio.Queue = asyncio.Queue()
+    async with aiohttp.ClientSession() as session:
+        clients = [AsyncVoicevoxClient(session, url, speaker) for url in urls]
+        for client in clients:
+            try:
+                log.info("VOICEVOX version (%s): %s", client.url, await client.version())
+            except Exception as e:  # noqa: BLE001
+                log.warning("WARN: version check failed for %s: %s", client.url, e)
+        warm = await asyncio.gather(*(client.warm_up() for client in clients), return_exceptions=True)
+        for client, result in zip(clients, warm):
+            if isinstance(result, Exception):
+                log.warning("WARN: warm-up failed for %s: %s", client.url, result)
+
+        pool: asyncio.Queue = asyncio.Queue()
+        for _ in range(ENGINE_SLOTS):
+            for client in clients:
+                pool.put_nowait(client)
+
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(n_synthesis):
+                tg.create_task(_synthesis_worker(pool, write, s_queue))
+            async with asyncio.TaskGroup() as query_tg:
+                for _ in range(n_query):
+                    query_tg.create_task(_query_worker(pool, query, q_queue, s_queue))
+            for _ in range(n_synthesis):
+                s_queue.put_nowait(_DONE)
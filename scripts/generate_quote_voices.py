@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 import argparse
-import json
+import asyncio
+import logging
 import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import requests
-from requests.exceptions import ConnectionError, HTTPError, Timeout
+import orjson
 
-VOICEVOX_URL_DEFAULT = os.environ.get("VOICEVOX_URL") or "http://localhost:50021"
-SPEAKER = 3  # ずんだもん（ノーマル）
+from _voicevox import SPEAKER, AsyncVoicevoxClient, cache_key, mark_cached, plan_jobs, run_pipeline, setup_logging
+
+VOICEVOX_URL_DEFAULT = os.environ.get("VOICEVOX_URLS") or os.environ.get("VOICEVOX_URL") or "http://localhost:50021"
+
+log = logging.getLogger(__name__)
 
 QUOTES: dict[str, list[str]] = {
     "DEFENSE": [
@@ -64,59 +70,127 @@ VOICE_PARAMS = {
 }
 
 
-def audio_query(url: str, text: str) -> dict:
-    r = requests.post(f"{url}/audio_query", params={"text": text, "speaker": SPEAKER}, timeout=30)
-    r.raise_for_status()
-    return r.json()
+def encode_opus(wav: bytes, opus_path: Path) -> None:
+    # Feed the WAV through stdin so freshly synthesized audio is never re-read from disk
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-i", "pipe:0", "-c:a", "libopus", "-b:a", "32k", str(opus_path)],
+        input=wav,
+        check=True,
+    )
+    log.info("Encoded %s", opus_path.name)
+
+
+def opus_is_stale(wav_path: Path) -> bool:
+    opus_path = wav_path.with_suffix(".opus")
+    return not opus_path.exists() or opus_path.stat().st_mtime < wav_path.stat().st_mtime
+
+
+async def query_line(client: AsyncVoicevoxClient, job: tuple) -> dict:
+    _, _, (category, line) = job
+    return await client.audio_query(line, VOICE_PARAMS.get(category))
+
+
+def build_manifest(ext: str) -> dict[str, list[str]]:
+    # A pure function of QUOTES, so the file is byte-identical across runs
+    return {category: [f"{category}_{i}{ext}" for i in range(len(lines))] for category, lines in QUOTES.items()}
+
+
+def write_manifest(out_dir: Path, manifest: dict[str, list[str]]) -> None:
+    path = out_dir / "manifest.json"
+    tmp = path.with_suffix(".json.tmp")
+    tmp.write_bytes(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, path)
 
 
-def synthesis(url: str, query: dict) -> bytes:
-    r = requests.post(f"{url}/synthesis", params={"speaker": SPEAKER}, json=query, timeout=60)
-    r.raise_for_status()
-    return r.content
+async def run(urls: list[str], out_dir: Path, opus: bool, force: bool) -> None:
+    jobs = [
+        (out_dir / f"{category}_{i}.wav", cache_key(SPEAKER, line, VOICE_PARAMS.get(category)), (category, line))
+        for category, lines in QUOTES.items()
+        for i, line in enumerate(lines)
+    ]
+    pending, dupes = plan_jobs(jobs, force)
+    batches: dict[str, list[tuple]] = {}
+    for job in pending:
+        # One batch per category, so each is synthesized in a single request
+        batches.setdefault(job[2][0], []).append(job)
+
+    # ffmpeg does the encoding in its own process, so threads are enough to fan it out across cores
+    encoder = ThreadPoolExecutor(max_workers=os.cpu_count()) if opus else None
+    encodes: dict[Path, asyncio.Future] = {}
+    loop = asyncio.get_running_loop()
+
+    async def write_line(job: tuple, wav: bytes) -> None:
+        out_path, key, _ = job
+        await asyncio.to_thread(out_path.write_bytes, wav)
+        mark_cached(out_path, key)
+        log.info("Generated %s (%d bytes)", out_path.name, len(wav))
+        if encoder:
+            # Not awaited here: ffmpeg runs while the worker moves on to the next batch
+            encodes[out_path] = loop.run_in_executor(encoder, encode_opus, wav, out_path.with_suffix(".opus"))
+
+    if pending:
+        await run_pipeline(urls, batches.values(), query_line, write_line)
+
+    for out_path, key, source in dupes:
+        shutil.copyfile(source, out_path)
+        mark_cached(out_path, key)
+        log.info("Copied %s from %s", out_path.name, source.name)
+
+    if encoder:
+        # Add whatever the workers didn't already submit (cached lines with a stale .opus,
+        # copied duplicates), then wait for every encode at once
+        for wav_path, _, _ in jobs:
+            if wav_path not in encodes and opus_is_stale(wav_path):
+                encodes[wav_path] = loop.run_in_executor(
+                    encoder, encode_opus, wav_path.read_bytes(), wav_path.with_suffix(".opus")
+                )
+        with encoder:
+            await asyncio.gather(*encodes.values())
+
+    write_manifest(out_dir, build_manifest(".opus" if opus else ".wav"))
+    log.info("Done.")
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Generate Zundamon quote voices")
-    parser.add_argument("--url", default=VOICEVOX_URL_DEFAULT, help="VOICEVOX base URL")
+    parser.add_argument("--url", default=VOICEVOX_URL_DEFAULT, help="VOICEVOX base URL(s), comma-separated")
     parser.add_argument("--out", default="public/sounds/voice/quotes", help="Output dir")
+    parser.add_argument(
+        "--opus",
+        action="store_true",
+        help="Also encode 32kbps .opus copies with ffmpeg and list those in manifest.json",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--manifest-only",
+        action="store_true",
+        help="Only rewrite manifest.json from the audio files already on disk",
+    )
+    mode.add_argument("--force", action="store_true", help="Re-synthesize every line, ignoring the cache")
     args = parser.parse_args()
+    setup_logging()
+    if args.opus and not args.manifest_only and shutil.which("ffmpeg") is None:
+        parser.error("--opus requires ffmpeg on PATH")
 
-    url = args.url.rstrip("/")
+    urls = [u.strip().rstrip("/") for u in args.url.split(",") if u.strip()]
+    if not urls and not args.manifest_only:
+        parser.error("--url: no VOICEVOX URL given")
     out_dir = Path(args.out)
     out_dir.mkdir(parents=True, exist_ok=True)
-    print(f"VOICEVOX: {url} (speaker={SPEAKER})")
-    print(f"Output: {out_dir.resolve()}")
-
-    try:
-        r = requests.get(f"{url}/version", timeout=10)
-        r.raise_for_status()
-        print(f"VOICEVOX version: {r.text}")
-    except Exception as e:  # noqa: BLE001
-        print(f"WARN: version check failed: {e}")
-
-    manifest = {}
-
-    for category, lines in QUOTES.items():
-        manifest[category] = []
-        for i, line in enumerate(lines):
-            filename = f"{category}_{i}.wav"
-            out_path = out_dir / filename
-            try:
-                query = audio_query(url, line)
-                tuning = VOICE_PARAMS.get(category)
-                if tuning:
-                    query.update(tuning)
-                wav = synthesis(url, query)
-                out_path.write_bytes(wav)
-                manifest[category].append(filename)
-                print(f"Generated {filename} ({len(wav)} bytes)")
-            except (ConnectionError, Timeout, HTTPError) as e:
-                print(f"ERROR: failed {category}:{i}: {e}")
-                raise
-
-    (out_dir / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
-    print("Done.")
+
+    if args.manifest_only:
+        expected = build_manifest(".opus" if args.opus else ".wav")
+        missing = [f for fs in expected.values() for f in fs if not (out_dir / f).exists()]
+        if missing:
+            parser.error(f"--manifest-only: missing {', '.join(missing)}")
+        write_manifest(out_dir, expected)
+        log.info("Done.")
+        return
+
+    log.info("VOICEVOX: %s (speaker=%d)", ", ".join(urls), SPEAKER)
+    log.info("Output: %s", out_dir.resolve())
+
+    asyncio.run(run(urls, out_dir, args.opus, args.force))
 
 
 if __name__ == "__main__":
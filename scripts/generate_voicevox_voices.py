@@ -2,16 +2,27 @@
 from __future__ import annotations
 
 import argparse
+import logging
 import os
+import queue
+import shutil
 import socket
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, TypeVar
 
-import requests
-from requests.exceptions import ConnectionError, HTTPError, Timeout
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError, Timeout
+
+from _voicevox import VoicevoxClient, cache_key, make_session, mark_cached, plan_jobs, setup_logging
 
 
 SPEAKER_ID = 3  # ずんだもん（ノーマル）
+PIPELINE_WORKERS = 2  # per stage and per engine; a single VOICEVOX engine gains little from more
+
+log = logging.getLogger(__name__)
+
+
 def _get_default_gateway_linux() -> str | None:
     try:
         with open("/proc/net/route", "r", encoding="utf-8") as f:
@@ -56,7 +67,7 @@ def _default_voicevox_host() -> str:
 
 DEFAULT_VOICEVOX_HOST = _default_voicevox_host()
 DEFAULT_VOICEVOX_PORT = os.environ.get("VOICEVOX_PORT") or "50021"
-DEFAULT_VOICEVOX_URL = os.environ.get("VOICEVOX_URL") or f"http://{DEFAULT_VOICEVOX_HOST}:{DEFAULT_VOICEVOX_PORT}"
+DEFAULT_VOICEVOX_URL = os.environ.get("VOICEVOX_URLS") or os.environ.get("VOICEVOX_URL") or f"http://{DEFAULT_VOICEVOX_HOST}:{DEFAULT_VOICEVOX_PORT}"
 DEFAULT_OUTPUT_DIR = Path("./public/sounds/voice")
 
 LINES: list[tuple[str, str]] = [
@@ -73,30 +84,19 @@ LINES: list[tuple[str, str]] = [
 ]
 
 
-def check_voicevox(url: str) -> None:
-    r = requests.get(f"{url}/speakers", timeout=10)
-    r.raise_for_status()
+# Engine clients available to workers; each call borrows one and hands it back
+_engines: queue.Queue[VoicevoxClient] = queue.Queue()
 
 
-def audio_query(url: str, text: str) -> dict:
-    r = requests.post(
-        f"{url}/audio_query",
-        params={"text": text, "speaker": SPEAKER_ID},
-        timeout=30,
-    )
-    r.raise_for_status()
-    return r.json()
+T = TypeVar("T")
 
 
-def synthesis(url: str, query: dict) -> bytes:
-    r = requests.post(
-        f"{url}/synthesis",
-        params={"speaker": SPEAKER_ID},
-        json=query,
-        timeout=60,
-    )
-    r.raise_for_status()
-    return r.content
+def _on_engine(call: Callable[..., T], *args: object) -> T:
+    client = _engines.get()
+    try:
+        return call(client, *args)
+    finally:
+        _engines.put(client)
 
 
 def main() -> None:
@@ -105,8 +105,9 @@ def main() -> None:
         "--url",
         default=DEFAULT_VOICEVOX_URL,
         help=(
-            "VOICEVOX engine URL (default: %(default)s). "
-            "You can also set VOICEVOX_HOST/VOICEVOX_PORT or VOICEVOX_URL."
+            "VOICEVOX engine URL (default: %(default)s). Pass several comma-separated URLs "
+            "to spread work across engines. You can also set VOICEVOX_HOST/VOICEVOX_PORT, "
+            "VOICEVOX_URL or VOICEVOX_URLS."
         ),
     )
     parser.add_argument(
@@ -115,21 +116,36 @@ def main() -> None:
         help="Output directory (default: %(default)s)",
     )
     args = parser.parse_args()
+    setup_logging()
 
-    voicevox_url: str = args.url
+    voicevox_urls = [u.strip() for u in args.url.split(",") if u.strip()]
+    if not voicevox_urls:
+        parser.error("--url: no VOICEVOX URL given")
     output_dir = Path(args.out)
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    pending, dupes = plan_jobs(
+        (output_dir / filename, cache_key(SPEAKER_ID, text, None), text) for filename, text in LINES
+    )
+    if not pending:
+        return
+
+    session = make_session()
+    clients = [VoicevoxClient(url, SPEAKER_ID, session) for url in voicevox_urls]
+
     print(
         "NOTE: Connection refusedになる場合は、VOICEVOXアプリの設定で『他コンピュータからの接続を許可』する必要があるか、"
         "Windows側のPowerShellから直接このスクリプトを実行してください。",
         file=sys.stderr,
     )
-    print(f"VOICEVOX: {voicevox_url} / speaker={SPEAKER_ID}")
-    print(f"Output:  {output_dir.resolve()}")
+    log.info("VOICEVOX: %s / speaker=%d", ", ".join(voicevox_urls), SPEAKER_ID)
+    log.info("Output:  %s", output_dir.resolve())
 
     try:
-        check_voicevox(voicevox_url)
+        for client in clients:
+            voicevox_url = client.url
+            client.check()
+            client.warm_up()
     except (ConnectionError, Timeout) as e:
         print("ERROR: Could not connect to VOICEVOX.", file=sys.stderr)
         print(f"  url: {voicevox_url}", file=sys.stderr)
@@ -139,23 +155,42 @@ def main() -> None:
         sys.exit(2)
     except HTTPError as e:
         print("ERROR: VOICEVOX responded with an HTTP error during healthcheck.", file=sys.stderr)
+        print(f"  url: {voicevox_url}", file=sys.stderr)
         print(f"  Details: {e}", file=sys.stderr)
         sys.exit(3)
 
+    for _ in range(PIPELINE_WORKERS):
+        for client in clients:
+            _engines.put(client)
+    workers = PIPELINE_WORKERS * len(clients)
+
+    # Two-stage pipeline: audio_query for line N+1 runs while line N is synthesized.
     generated = 0
-    for filename, text in LINES:
-        out_path = output_dir / filename
+    with ThreadPoolExecutor(workers) as query_pool, ThreadPoolExecutor(workers) as synth_pool:
+        queries = [query_pool.submit(_on_engine, VoicevoxClient.audio_query, text) for _, _, text in pending]
+        synths: list[Future[int]] = []
         try:
-            query = audio_query(voicevox_url, text)
-            wav = synthesis(voicevox_url, query)
-        except (ConnectionError, Timeout, HTTPError) as e:
-            print(f"ERROR: Failed to generate {filename}: {e}", file=sys.stderr)
+            for (out_path, _, _), query_future in zip(pending, queries):
+                query = query_future.result()
+                synths.append(synth_pool.submit(_on_engine, VoicevoxClient.synthesis_to, query, out_path))
+            for (out_path, key, text), synth_future in zip(pending, synths):
+                size = synth_future.result()
+                mark_cached(out_path, key)
+                generated += 1
+                log.info("Generated: %s (%d bytes)  text=%s", out_path, size, text)
+        except (ConnectionError, Timeout, HTTPError, ChunkedEncodingError) as e:
+            print(f"ERROR: Failed to generate {out_path.name}: {e}", file=sys.stderr)
+            query_pool.shutdown(cancel_futures=True)
+            synth_pool.shutdown(cancel_futures=True)
             sys.exit(4)
-        out_path.write_bytes(wav)
+
+    for out_path, key, source in dupes:
+        shutil.copyfile(source, out_path)
+        mark_cached(out_path, key)
         generated += 1
-        print(f"Generated: {out_path} ({len(wav)} bytes)  text={text}")
+        log.info("Copied:    %s (%d bytes)  from=%s", out_path, out_path.stat().st_size, source.name)
 
-    print(f"Done. Generated {generated} files.")
+    log.info("Done. Generated %d files.", generated)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,23 @@
-import requests
-import json
-import time
+import asyncio
+import logging
+import os
+import shutil
+import sys
+from pathlib import Path
+
+from scripts._voicevox import cache_key, mark_cached, plan_jobs, run_pipeline, setup_logging
 
 host = "localhost"
 port = 50021
 speaker_id = 3
+# Comma-separated list to spread work across several engines (see README)
+urls = [
+    u.strip().rstrip("/")
+    for u in os.environ.get("VOICEVOX_URLS", f"http://{host}:{port}").split(",")
+    if u.strip()
+]
+if not urls:
+    sys.exit("ERROR: VOICEVOX_URLS contains no engine URL")
 
 voices = [
     # Fixed Safe Tile voice (Using Hiragana "あんぜんさく" to prevent misreading)
@@ -32,22 +45,38 @@ voices = [
     }
 ]
 
-def generate_wav(voice_data):
-    params = (("text", voice_data["text"]), ("speaker", speaker_id))
-    q = requests.post(f"http://{host}:{port}/audio_query", params=params).json()
-    q["speedScale"] = voice_data["speed"]
-    q["pitchScale"] = voice_data["pitch"]
-    q["intonationScale"] = voice_data["intonation"]
-    res = requests.post(
-        f"http://{host}:{port}/synthesis",
-        headers={"Content-Type": "application/json"},
-        params=params,
-        data=json.dumps(q),
+log = logging.getLogger(__name__)
+
+def tuning_for(voice_data):
+    return {
+        "speedScale": voice_data["speed"],
+        "pitchScale": voice_data["pitch"],
+        "intonationScale": voice_data["intonation"],
+    }
+
+async def query_voice(client, job):
+    _, _, voice_data = job
+    return await client.audio_query(voice_data["text"], tuning_for(voice_data))
+
+async def write_voice(job, wav):
+    out_path, key, voice_data = job
+    await asyncio.to_thread(out_path.write_bytes, wav)
+    mark_cached(out_path, key)
+    log.info("Generated: %s (%d bytes)", voice_data["filename"], len(wav))
+
+async def main():
+    pending, dupes = plan_jobs(
+        (Path(v["filename"]), cache_key(speaker_id, v["text"], tuning_for(v)), v) for v in voices
     )
-    with open(voice_data["filename"], "wb") as f:
-        f.write(res.content)
-    print(f"Generated: {voice_data['filename']}")
-    time.sleep(0.5)
+    if not pending:
+        return
+    # One line per batch: these are independent lines, so each gets its own /synthesis call
+    await run_pipeline(urls, ([job] for job in pending), query_voice, write_voice, speaker_id)
+
+    for out_path, key, source in dupes:
+        shutil.copyfile(source, out_path)
+        mark_cached(out_path, key)
+        log.info("Copied: %s", out_path)
 
-for v in voices:
-    generate_wav(v)
+setup_logging()
+asyncio.run(main())